@@ -4,6 +4,8 @@
 import json
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 from tqdm import tqdm
 from pathlib import Path
 import time
@@ -20,7 +22,6 @@ from torch.utils.data import DataLoader, Dataset
 from sklearn.model_selection import GroupKFold
 import random
 import os
-from cuml.neighbors import NearestNeighbors
 from transformers import BitsAndBytesConfig
 from torch import Tensor
 from peft import LoraConfig, get_peft_model
@@ -85,35 +86,6 @@ def set_seed(seed: int = 42):
     torch.backends.cudnn.benchmark = False
 
 
-class EediValDataset(Dataset):
-    def __init__(self, text1,
-                 tokenizer, max_len):
-        self.text1 = text1
-        self.tokenizer = tokenizer
-        self.max_len = max_len
-
-    def __len__(self):
-        return len(self.text1)
-
-    def __getitem__(self, item):
-        text1 = self.text1[item]
-        inputs1 = self.tokenizer(
-            text1,
-            max_length=self.max_len,
-            padding="max_length",
-            truncation=True,
-            return_attention_mask=True,
-            return_token_type_ids=True
-        )
-        inputs1 = {"input_ids": torch.tensor(inputs1["input_ids"], dtype=torch.long),
-                   "attention_mask": torch.tensor(inputs1["attention_mask"],
-                                                  dtype=torch.long),
-                   "token_type_ids": torch.tensor(inputs1["token_type_ids"],
-                                                  dtype=torch.long)}
-
-        return inputs1
-
-
 class Qwen2ModelLabel(Qwen2ForCausalLM):
     def __init__(self, config):
         super().__init__(config)
@@ -151,7 +123,10 @@ class BiEncoderModel(nn.Module):
                  sentence_pooling_method: str = "last"
                  ):
         super().__init__()
-        model = Qwen2ModelLabel.from_pretrained(model_path)
+        # SDPA dispatches to the fused flash-attention kernels and avoids
+        # materializing the L x L softmax in HBM
+        model = Qwen2ModelLabel.from_pretrained(model_path,
+                                                attn_implementation="sdpa")
         model.enable_input_require_grads()
         # model = IgnoreLabelsWrapper(model)
         config = LoraConfig(
@@ -320,7 +295,9 @@ def cos_sim(a, b):
 
     a_norm = torch.nn.functional.normalize(a, p=2, dim=1)
     b_norm = torch.nn.functional.normalize(b, p=2, dim=1)
-    return torch.mm(a_norm, b_norm.transpose(0, 1))
+    # F.linear treats b_norm as the GEMM's transposed operand directly, so no
+    # transposed view / extra cast is involved and fp16 inputs stay fp16
+    return torch.nn.functional.linear(a_norm, b_norm)
 
 
 def collate_sentence(d):
@@ -329,85 +306,84 @@ def collate_sentence(d):
             "attention_mask": d['attention_mask'][:, :mask_len]}
 
 
+def tokenize_for_emb(texts, tokenizer, max_len):
+    # tokenize the whole corpus once without padding; padding everything to
+    # max_len would spend most of the 32B forward on PAD tokens
+    input_ids = tokenizer(list(texts), max_length=max_len,
+                          truncation=True)["input_ids"]
+    return input_ids
+
+
 def make_candidate_first_stage_for_val(val, misconception,
                                        model, tokenizer, max_len,
                                        batch_size, n_neighbor=100):
-    val_ = EediValDataset(val["all_text"],
-                          tokenizer,
-                          max_len)
-    misconception_ = EediValDataset(misconception["MisconceptionName"],
-                                    tokenizer,
-                                    max_len)
+    val_ids = tokenize_for_emb(val["all_text"], tokenizer, max_len)
+    misconception_ids = tokenize_for_emb(misconception["MisconceptionName"],
+                                         tokenizer, max_len)
     # make val emb
-    val_loader = DataLoader(
-        val_, batch_size=batch_size * 2, shuffle=False)
-    val_emb = make_emb(model, val_loader)
+    val_emb = make_emb(model, tokenizer, val_ids, batch_size * 2)
 
     # make misconception emb
-    misconcept_loader = DataLoader(
-        misconception_, batch_size=batch_size * 2, shuffle=False)
-    misconcept_emb = make_emb(model, misconcept_loader)
-
-    knn = NearestNeighbors(n_neighbors=n_neighbor,
-                           metric="cosine")
-    knn.fit(misconcept_emb)
-    dists, nears = knn.kneighbors(val_emb)
+    misconcept_emb = make_emb(model, tokenizer, misconception_ids,
+                              batch_size * 2)
+
+    # both embedding sets are already L2-normalized fp16 on the GPU, so the
+    # brute-force cosine top-k is a single F.linear over the whole table
+    with torch.inference_mode():
+        sims = torch.nn.functional.linear(val_emb, misconcept_emb)
+        nears = torch.topk(sims, k=n_neighbor, dim=1).indices.cpu().numpy()
     return nears
 
 
-def make_emb(model, train_loader):
+def make_emb(model, tokenizer, input_ids_list, batch_size):
+    # sort by length so every batch is length-homogeneous and only gets
+    # padded up to its own longest sequence
+    lengths = np.array([len(ids) for ids in input_ids_list])
+    order = np.argsort(lengths)
     bert_emb = []
-    with torch.no_grad():
-        for d in train_loader:
-            d = collate_sentence(d)
-            input_ids = d['input_ids']
-            mask = d['attention_mask']
-            input_ids = input_ids.to(device)
-            mask = mask.to(device)
-            output = model(input_ids, mask)
-            output = output.detach().cpu().numpy().astype(np.float32)
-            bert_emb.append(output)
-    torch.cuda.empty_cache()
-    bert_emb = np.concatenate(bert_emb)
+    # inference_mode also skips autograd view/version tracking that
+    # no_grad still pays for
+    with torch.inference_mode():
+        for i in range(0, len(order), batch_size):
+            batch_ids = [input_ids_list[j] for j in order[i:i + batch_size]]
+            # pad to a multiple of 16 so the forward only ever sees a small,
+            # reusable set of shapes (also keeps the GEMMs tensor-core friendly)
+            d = tokenizer.pad({"input_ids": batch_ids}, return_tensors="pt",
+                              pad_to_multiple_of=16)
+            input_ids = d['input_ids'].to(device)
+            mask = d['attention_mask'].to(device)
+            # run the LoRA path and pooling tail in FP16 like the training
+            # forward, instead of letting them fall back to FP32
+            with autocast(dtype=torch.float16):
+                output = model(input_ids, mask)
+            # fuse normalization into the embedding pass and keep the batch
+            # on GPU in fp16; the similarity GEMM consumes it directly with
+            # no host round-trip between the two passes
+            output = torch.nn.functional.normalize(output.float(), dim=-1)
+            bert_emb.append(output.half())
+        bert_emb = torch.cat(bert_emb)
+        # undo the length sort
+        bert_emb = bert_emb[torch.from_numpy(np.argsort(order)).to(device)]
     return bert_emb
 
 
-def calculate_map25_with_metrics(df):
-    def ap_at_k(actual, predicted, k=25):
-        actual = int(actual)
-        predicted = predicted[:k]
-        score = 0.0
-        num_hits = 0.0
-        found = False
-        rank = None
-        for i, p in enumerate(predicted):
-            if p == actual:
-                if not found:
-                    found = True
-                    rank = i + 1
-                num_hits += 1
-                score += num_hits / (i + 1.0)
-        return score, found, rank
-
-    scores = []
-    found_count = 0
-    rankings = []
-    total_count = 0
-
-    for _, row in df.iterrows():
-        actual = row['MisconceptionId']
-        predicted = [int(float(x)) for x in row['pred'].split()]
-        score, found, rank = ap_at_k(actual, predicted)
-        scores.append(score)
-
-        total_count += 1
-        if found:
-            found_count += 1
-            rankings.append(rank)
+def calculate_map25_with_metrics(df, k=25):
+    # every row has the same number of candidates, so the whole metric is a
+    # single (n_rows, k) comparison instead of iterrows + per-row splits
+    actual = df['MisconceptionId'].astype(int).to_numpy()[:, None]
+    predicted = np.array([row.split() for row in df['pred']],
+                         dtype=np.float64).astype(int)[:, :k]
+
+    hits = predicted == actual
+    num_hits = np.cumsum(hits, axis=1)
+    scores = (hits * num_hits
+              / (np.arange(predicted.shape[1]) + 1.0)).sum(axis=1)
+    found = hits.any(axis=1)
+    ranks = hits.argmax(axis=1) + 1
 
     map25 = np.mean(scores)
-    percent_found = (found_count / total_count) * 100 if total_count > 0 else 0
-    avg_ranking = np.mean(rankings) if rankings else 0
+    percent_found = found.mean() * 100 if len(df) > 0 else 0
+    avg_ranking = ranks[found].mean() if found.any() else 0
 
     return map25, percent_found, avg_ranking
 
@@ -415,31 +391,28 @@ def calculate_map25_with_metrics(df):
 class EediTrainDataset(Dataset):
     def __init__(self, querys, misconception,
                  tokenizer, max_len):
-        self.querys = querys
-        self.misconception = misconception
-        self.tokenizer = tokenizer
-        self.max_len = max_len
-
-    def __len__(self):
-        return len(self.querys)
-
-    def __getitem__(self, item):
-        query = self.querys[item]
-        misconception = self.misconception[item]
-        inputs1 = self.tokenizer(
-            query,
-            max_length=self.max_len,
+        # tokenize every query once up front and keep ids/masks as two
+        # stacked tensors; __getitem__ is then a pure index, instead of
+        # re-running the tokenizer on the same text every epoch
+        inputs = tokenizer(
+            list(querys),
+            max_length=max_len,
             padding="max_length",
             truncation=True,
             return_attention_mask=True,
-            return_token_type_ids=True
+            return_tensors="pt"
         )
+        self.input_ids = inputs["input_ids"]
+        self.attention_mask = inputs["attention_mask"]
+        self.misconception = misconception
 
-        inputs1 = {"input_ids": torch.tensor(inputs1["input_ids"],
-                                             dtype=torch.long),
-                   "attention_mask": torch.tensor(inputs1["attention_mask"],
-                                                  dtype=torch.long)}
-        return {"inputs1": inputs1, "misconception": misconception}
+    def __len__(self):
+        return len(self.input_ids)
+
+    def __getitem__(self, item):
+        inputs1 = {"input_ids": self.input_ids[item],
+                   "attention_mask": self.attention_mask[item]}
+        return {"inputs1": inputs1, "misconception": self.misconception[item]}
 
 
 def compute_similarity(q_reps, p_reps):
@@ -491,18 +464,22 @@ misconception = pd.read_csv(MISCONCEPTION_MAPPING_PATH)
 llm_text = pd.read_csv(LLM_TEXT_PATH)
 df_fold = pd.read_csv(FOLD_PATH)
 
-train_pivot = []
 common_cols = ['QuestionId', 'ConstructId', 'ConstructName', 'SubjectId',
                'SubjectName', 'CorrectAnswer', 'QuestionText']
-for i in ["A", "B", "C", "D"]:
-    train_ = train.copy()
-    train_ = train[common_cols + [f"Answer{i}Text", f"Misconception{i}Id"]]
-    train_ = train_.rename({f"Answer{i}Text": "AnswerText",
-                            f"Misconception{i}Id": "MisconceptionId"}, axis=1)
-    train_["ans"] = i
-    train_pivot.append(train_)
-
-train_pivot = pd.concat(train_pivot).reset_index(drop=True)
+# long-form reshape with two melts instead of copying train once per
+# answer option; "AnswerAText"[6] / "MisconceptionAId"[13] is the option
+train_pivot = train.melt(
+    id_vars=common_cols,
+    value_vars=[f"Answer{i}Text" for i in "ABCD"],
+    var_name="ans", value_name="AnswerText")
+train_pivot["ans"] = train_pivot["ans"].str[6]
+misconception_pivot = train.melt(
+    id_vars=["QuestionId"],
+    value_vars=[f"Misconception{i}Id" for i in "ABCD"],
+    var_name="ans", value_name="MisconceptionId")
+misconception_pivot["ans"] = misconception_pivot["ans"].str[13]
+train_pivot = train_pivot.merge(misconception_pivot,
+                                how="left", on=["QuestionId", "ans"])
 train_pivot_correct_ans = train_pivot[
     train_pivot["CorrectAnswer"] == train_pivot["ans"]].reset_index(drop=True)
 train_pivot_correct_ans = train_pivot_correct_ans[[
@@ -516,20 +493,21 @@ train_pivot = train_pivot.merge(
 train_pivot = train_pivot.merge(
     train_pivot_correct_ans, how="left", on="QuestionId")
 
-train_pivot["all_text"] = ' <Question> ' + train_pivot['QuestionText'] + \
-    ' <Correct Answer> ' + train_pivot['CorrectAnswerText'] + \
-    ' <Incorrect Answer> ' + train_pivot['AnswerText'] + \
-    ' <Construct> ' + train_pivot['ConstructName'] + \
-    ' <Subject> ' + train_pivot['SubjectName'] + \
-    ' <LLMOutput> ' + train_pivot['llmMisconception']
+# one arrow kernel instead of five intermediate pandas string columns;
+# the constant instruct prefix is one more literal in the same call
+train_pivot["all_text"] = pc.binary_join_element_wise(
+    f'Instruct: {task}\nQuery: ',
+    ' <Question> ', pa.array(train_pivot['QuestionText']),
+    ' <Correct Answer> ', pa.array(train_pivot['CorrectAnswerText']),
+    ' <Incorrect Answer> ', pa.array(train_pivot['AnswerText']),
+    ' <Construct> ', pa.array(train_pivot['ConstructName']),
+    ' <Subject> ', pa.array(train_pivot['SubjectName']),
+    ' <LLMOutput> ', pa.array(train_pivot['llmMisconception']),
+    '').to_pandas()
 train_pivot["MisconceptionId"] = train_pivot["MisconceptionId"].astype(int)
 train_pivot = train_pivot.merge(
     misconception, how="left", on="MisconceptionId")
 
-text_list = []
-for t in train_pivot["all_text"].values:
-    text_list.append(get_detailed_instruct(task, t))
-train_pivot["all_text"] = text_list
 df_fold = df_fold.drop_duplicates(subset=["QuestionId"]).reset_index(drop=True)
 train_pivot = train_pivot.merge(
     df_fold[["QuestionId", "fold"]], how="left", on="QuestionId")
@@ -560,7 +538,8 @@ with timer("train"):
                                   batch_size=batch_size,
                                   shuffle=True,
                                   pin_memory=True,
-                                  num_workers=0)
+                                  num_workers=4,
+                                  persistent_workers=True)
 
         model = BiEncoderModel()
         model.gradient_checkpointing_enable()
@@ -605,32 +584,25 @@ with timer("train"):
                 for i in misconception_.numpy():
                     label_index = np.where(train_misconception_ == i)[0][0]
                     target.append(label_index)
-                passage_input_ids = []
-                passage_attention_masks = []
-                for p in train_misconception_:
-                    inputs = tokenizer(
-                        misconception_name[p],
-                        max_length=256,
-                        padding="max_length",
-                        truncation=True,
-                        return_attention_mask=True,
-                        return_token_type_ids=True
-                    )
-                    passage_input_ids.append(inputs["input_ids"])
-                    passage_attention_masks.append(inputs["attention_mask"])
-                passage_input_ids = torch.tensor(
-                    passage_input_ids, dtype=torch.long)
-                passage_attention_masks = torch.tensor(
-                    passage_attention_masks, dtype=torch.long)
-                d2 = {'input_ids': passage_input_ids,
-                      "attention_mask": passage_attention_masks}
-                d2 = collate_sentence(d2)
-
-                ids1 = d1["input_ids"].to(device)
-                mask1 = d1['attention_mask'].to(device)
-
-                ids2 = d2["input_ids"].to(device)
-                mask2 = d2['attention_mask'].to(device)
+                # one batched call into the Rust tokenizer (parallelized via
+                # TOKENIZERS_PARALLELISM) instead of a Python loop per passage;
+                # padding="longest" already does what collate_sentence did
+                inputs = tokenizer(
+                    list(misconception_name[train_misconception_]),
+                    max_length=256,
+                    padding="longest",
+                    truncation=True,
+                    return_attention_mask=True,
+                    return_tensors="pt"
+                )
+                d2 = {'input_ids': inputs["input_ids"],
+                      "attention_mask": inputs["attention_mask"]}
+
+                ids1 = d1["input_ids"].to(device, non_blocking=True)
+                mask1 = d1['attention_mask'].to(device, non_blocking=True)
+
+                ids2 = d2["input_ids"].to(device, non_blocking=True)
+                mask2 = d2['attention_mask'].to(device, non_blocking=True)
                 with autocast():
                     q_reps = model(ids1, mask1)
                     p_reps = model(ids2, mask2)
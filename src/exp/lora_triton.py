@@ -0,0 +1,97 @@
+# =========================
+# fused LoRA forward (Triton)
+# =========================
+# The retriever adapters all use a fixed rank of 32, so the two skinny
+# GEMMs of the LoRA path (x @ A^T then @ B^T) can be fused into a single
+# kernel: the rank-32 intermediate never leaves registers/SMEM and the
+# activations are read from HBM once instead of twice.
+import torch
+import triton
+import triton.language as tl
+
+
+@triton.jit
+def _fused_lora_kernel(x_ptr, a_ptr, b_ptr, out_ptr,
+                       M, N, K, scaling,
+                       stride_xm, stride_xk,
+                       stride_ar, stride_ak,
+                       stride_bn, stride_br,
+                       stride_om, stride_on,
+                       BLOCK_M: tl.constexpr, BLOCK_N: tl.constexpr,
+                       BLOCK_K: tl.constexpr, R: tl.constexpr):
+    pid = tl.program_id(0)
+    offs_m = pid * BLOCK_M + tl.arange(0, BLOCK_M)
+    offs_r = tl.arange(0, R)
+
+    # t = x @ A^T, accumulated over K tiles; (BLOCK_M, R) stays on chip
+    acc_t = tl.zeros((BLOCK_M, R), dtype=tl.float32)
+    for k0 in range(0, K, BLOCK_K):
+        offs_k = k0 + tl.arange(0, BLOCK_K)
+        x_tile = tl.load(
+            x_ptr + offs_m[:, None] * stride_xm + offs_k[None, :] * stride_xk,
+            mask=(offs_m[:, None] < M) & (offs_k[None, :] < K), other=0.)
+        a_tile = tl.load(
+            a_ptr + offs_r[:, None] * stride_ar + offs_k[None, :] * stride_ak,
+            mask=offs_k[None, :] < K, other=0.)
+        acc_t += tl.dot(x_tile, tl.trans(a_tile))
+    t = acc_t.to(tl.float16)
+
+    # out = (t @ B^T) * scaling, streamed over N tiles
+    for n0 in range(0, N, BLOCK_N):
+        offs_n = n0 + tl.arange(0, BLOCK_N)
+        b_tile = tl.load(
+            b_ptr + offs_n[:, None] * stride_bn + offs_r[None, :] * stride_br,
+            mask=offs_n[:, None] < N, other=0.)
+        out = tl.dot(t, tl.trans(b_tile)) * scaling
+        tl.store(
+            out_ptr + offs_m[:, None] * stride_om + offs_n[None, :] * stride_on,
+            out.to(tl.float16),
+            mask=(offs_m[:, None] < M) & (offs_n[None, :] < N))
+
+
+def fused_lora_delta(x, lora_a, lora_b, scaling):
+    x2d = x.reshape(-1, x.shape[-1]).contiguous()
+    M, K = x2d.shape
+    N = lora_b.shape[0]
+    out = torch.empty((M, N), device=x.device, dtype=torch.float16)
+    grid = (triton.cdiv(M, 64),)
+    _fused_lora_kernel[grid](
+        x2d, lora_a, lora_b, out,
+        M, N, K, scaling,
+        x2d.stride(0), x2d.stride(1),
+        lora_a.stride(0), lora_a.stride(1),
+        lora_b.stride(0), lora_b.stride(1),
+        out.stride(0), out.stride(1),
+        BLOCK_M=64, BLOCK_N=128, BLOCK_K=64, R=lora_a.shape[0])
+    return out.reshape(*x.shape[:-1], N)
+
+
+def apply_fused_lora(model, adapter_name="default"):
+    # patch every LoRA layer of the given adapter to run the fused kernel at
+    # inference; dropout is inactive in eval so the delta is exact
+    from peft.tuners.lora import LoraLayer
+    n_patched = 0
+    for module in model.modules():
+        if not isinstance(module, LoraLayer):
+            continue
+        if adapter_name not in module.lora_A:
+            continue
+        lora_a = module.lora_A[adapter_name].weight.detach().half()
+        lora_b = module.lora_B[adapter_name].weight.detach().half()
+        r = lora_a.shape[0]
+        # tl.dot needs a power-of-two rank of at least 16
+        if r < 16 or (r & (r - 1)) != 0:
+            continue
+        scaling = module.scaling[adapter_name]
+        base_layer = module.get_base_layer()
+
+        def _make_forward(base_layer, lora_a, lora_b, scaling):
+            def forward(x, *args, **kwargs):
+                result = base_layer(x, *args, **kwargs)
+                return result + fused_lora_delta(
+                    x.to(lora_a.dtype), lora_a, lora_b, scaling)
+            return forward
+
+        module.forward = _make_forward(base_layer, lora_a, lora_b, scaling)
+        n_patched += 1
+    return n_patched
@@ -26,17 +26,22 @@ def main(args):
         correct_answer_text = row[f"Answer{row['CorrectAnswer']}Text"]
         correct_answer_texts.append(correct_answer_text)
     train["CorrectAnswerText"] = correct_answer_texts
-    train_pivot = []
     common_cols = ['QuestionId', 'ConstructId', 'ConstructName', 'SubjectId',
                 'SubjectName', 'CorrectAnswer', 'QuestionText', 'CorrectAnswerText']
-    for i in ["A", "B", "C", "D"]:
-        train_ = train.copy()
-        train_ = train[common_cols + [f"Answer{i}Text", f"Misconception{i}Id"]]
-        train_ = train_.rename({f"Answer{i}Text": "AnswerText",
-                                f"Misconception{i}Id": "MisconceptionId"}, axis=1)
-        train_["ans"] = i
-        train_pivot.append(train_)
-    train_pivot = pd.concat(train_pivot).reset_index(drop=True)
+    # long-form reshape with two melts instead of copying train once per
+    # answer option; "AnswerAText"[6] / "MisconceptionAId"[13] is the option
+    train_pivot = train.melt(
+        id_vars=common_cols,
+        value_vars=[f"Answer{i}Text" for i in "ABCD"],
+        var_name="ans", value_name="AnswerText")
+    train_pivot["ans"] = train_pivot["ans"].str[6]
+    misconception_pivot = train.melt(
+        id_vars=["QuestionId"],
+        value_vars=[f"Misconception{i}Id" for i in "ABCD"],
+        var_name="ans", value_name="MisconceptionId")
+    misconception_pivot["ans"] = misconception_pivot["ans"].str[13]
+    train_pivot = train_pivot.merge(misconception_pivot,
+                                    how="left", on=["QuestionId", "ans"])
     train_pivot = train_pivot[train_pivot["MisconceptionId"].notnull()].reset_index(
         drop=True)
     train_pivot["MisconceptionId"] = train_pivot["MisconceptionId"].astype(int)